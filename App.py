@@ -1,26 +1,34 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
 import gspread
 import json
+import functools
+import importlib.util
 from google.oauth2.service_account import Credentials
 from datetime import datetime
 import time
 
 # --- ライブラリのインポート ---
-# requirements.txt に "geopy", "folium", "streamlit-folium" を追加してください
+# requirements.txt に "geopy", "folium" を追加してください
 try:
     from geopy.geocoders import Nominatim
+    from geopy.extra.rate_limiter import RateLimiter
     GEOPY_AVAILABLE = True
 except ImportError:
     GEOPY_AVAILABLE = False
 
 try:
     import folium
-    from streamlit_folium import st_folium
+    from folium.plugins import FastMarkerCluster
     FOLIUM_AVAILABLE = True
 except ImportError:
     FOLIUM_AVAILABLE = False
 
+# pyarrow があれば文字列列を Arrow 形式で持つ（検索が速くなる）
+if importlib.util.find_spec("pyarrow") is not None:
+    pd.options.mode.string_storage = "pyarrow"
+
 # --- 設定 ---
 SHEET_NAME = "立川グルメ管理"
 SCOPES = [
@@ -28,6 +36,38 @@ SCOPES = [
     "https://www.googleapis.com/auth/drive"
 ]
 
+# 行番号で書き込む前に、他の人の追加・削除でずれていないか確認し、ずれていたら出すメッセージ
+STALE_SHEET_WARNING = "⚠️ 読み込み後にスプレッドシートが更新されています。「データ再読み込み」を押してから、もう一度やり直してください。"
+
+# お店リスト編集用 data_editor の key（未保存の変更の有無を確認するため）
+EDITOR_KEY = "shop_editor"
+
+# 新規登録はこの件数まで溜めてからまとめて送信する
+PENDING_INSERT_LIMIT = 5
+
+# 選択肢（一覧の編集と新規登録で共通）
+GENRE_OPTIONS = ("和食", "洋食", "中華", "イタリアン", "ラーメン", "カフェ", "居酒屋", "その他")
+AREA_OPTIONS = ("北口", "南口", "グリーンスプリングス", "ららぽーと", "駅ナカ", "その他")
+
+# 文字列として扱う列
+TEXT_COLUMNS = ["店名", "ジャンル", "エリア", "メモ", "住所", "登録日"]
+
+# 地図の描画に使う列
+MAP_COLUMNS = ["緯度", "経度", "店名", "ジャンル", "エリア", "メモ"]
+
+# マーカーはブラウザ側 (Leaflet) で組み立てる。row = [緯度, 経度, ポップアップHTML, 店名]
+# DOM要素を増やさないよう、canvasに描画される circleMarker を使う
+MARKER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 8, weight: 2, fillOpacity: 0.7});
+    marker.bindPopup(row[2], {maxWidth: 200});
+    marker.bindTooltip(row[3]);
+    return marker;
+};
+"""
+
+# 接続はプロセス内で使い回す（st.stop で中断した場合はキャッシュされないので、設定ミス時は毎回エラー表示される）
+@st.cache_resource(show_spinner=False)
 def get_connection():
     """GCP認証と接続"""
     if "gcp_service_account" not in st.secrets:
@@ -61,6 +101,321 @@ def get_connection():
         st.error(f"認証エラー: {e}")
         st.stop()
 
+@st.cache_resource(show_spinner=False)
+def get_worksheet(sheet_name):
+    """ワークシートを取得（プロセス内で使い回す）"""
+    client = get_connection()
+    return client.open(sheet_name).sheet1
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_sheet_df(sheet_name):
+    """シートの全データをDataFrameで取得（60秒キャッシュ）"""
+    # get_all_records は行ごとに dict を作るので、値のリストから直接組み立てる
+    values = get_worksheet(sheet_name).get_all_values()
+    if not values:
+        return pd.DataFrame()
+    df = pd.DataFrame(values[1:], columns=values[0])
+
+    # 型変換は読み込み時に一度だけ行う
+    for col in ["緯度", "経度"]:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+    if "評価" in df.columns:
+        rating = pd.to_numeric(df["評価"], errors="coerce")
+        # シートに直接入力された範囲外・無限大の値で読み込みごと失敗しないよう、1〜5以外は空欄扱い
+        df["評価"] = rating.where(rating.between(1, 5)).round().astype("Int16")
+    for col in TEXT_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype(pd.StringDtype())
+    return df
+
+@st.cache_resource(show_spinner=False)
+def get_geolocator():
+    """ジオコーダーを取得（HTTPセッションを使い回す）"""
+    return Nominatim(user_agent="tachikawa_app")
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limited_geocode():
+    """Nominatimの利用規約（1秒1リクエスト）を守る geocode を取得"""
+    return RateLimiter(get_geolocator().geocode, min_delay_seconds=1, swallow_exceptions=False)
+
+def compose_geocode_query(address):
+    """「東京都立川市」を補った検索用の住所を作る"""
+    if "立川" not in address:
+        return "東京都立川市 " + address
+    if "東京都" not in address:
+        return "東京都 " + address
+    return address
+
+@st.cache_data(ttl=86400, max_entries=1024, show_spinner=False)
+def geocode_addr(query):
+    """住所から (緯度, 経度, 住所表記) を検索（1日キャッシュ）。見つからなければ None"""
+    loc = get_rate_limited_geocode()(query)
+    if not loc:
+        return None
+    return loc.latitude, loc.longitude, loc.address
+
+def flush_pending_inserts():
+    """溜めておいた新規登録をまとめてシートに追加し、追加した件数を返す"""
+    pending = st.session_state.get("pending_inserts")
+    if not pending:
+        return 0
+    get_worksheet(SHEET_NAME).append_rows(pending)
+    st.session_state["pending_inserts"] = []
+    load_sheet_df.clear()
+    return len(pending)
+
+def get_search_haystack(df):
+    """検索用に各行の全列を連結した文字列を作る（データが変わるまで使い回す）"""
+    # 0行の DataFrame に agg(axis=1) すると Series ではなく DataFrame が返るので先に処理
+    if df.empty:
+        return pd.Series([], index=df.index, dtype=pd.StringDtype())
+    key = int(pd.util.hash_pandas_object(df, index=True).sum())
+    cached = st.session_state.get("search_haystack")
+    if cached is None or cached[0] != key:
+        haystack = df.astype(object).fillna("").astype(str).agg(" ".join, axis=1)
+        cached = (key, haystack.astype(pd.StringDtype()))
+        st.session_state["search_haystack"] = cached
+    return cached[1]
+
+def build_popup_html(map_df):
+    """ポップアップ用HTMLを列単位の文字列演算でまとめて作る（行ごとのループはしない）"""
+    # 空欄が "nan" や "<NA>" と表示されないよう、文字列化は一度だけまとめて行う
+    text = map_df[["店名", "ジャンル", "エリア", "メモ"]].astype(object).fillna("").astype(str)
+    gmap_url = (
+        "https://www.google.com/maps/search/?api=1&query="
+        + map_df["緯度"].astype(str) + "," + map_df["経度"].astype(str)
+    )
+    return (
+        '<div style="font-family:sans-serif; min-width:150px;">'
+        + "<b>" + text["店名"] + "</b><br>"
+        + '<span style="font-size:0.9em; color:gray;">'
+        + text["ジャンル"] + " / " + text["エリア"] + "</span><br>"
+        + "<br>"
+        + text["メモ"].str.slice(0, 20) + "...<br>"
+        + '<a href="' + gmap_url + '" target="_blank" style="color:blue; text-decoration:underline;">Googleマップで見る</a>'
+        + "</div>"
+    )
+
+def hash_df(df):
+    """DataFrameの中身から軽量なハッシュを作る（キャッシュのキー用）"""
+    return len(df), int(pd.util.hash_pandas_object(df, index=False).sum())
+
+# DataFrame はピクルス化せず、ベクトル化されたハッシュで比較する
+# 参照されるのは最新のデータだけなので、古い地図がメモリに溜まらないよう数件に制限
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs={pd.DataFrame: hash_df})
+def build_map_html(map_df):
+    """地図のHTMLを生成（同じデータなら再生成しない）"""
+
+    center_lat = map_df["緯度"].mean()
+    center_lon = map_df["経度"].mean()
+
+    m = folium.Map(location=[center_lat, center_lon], zoom_start=14, prefer_canvas=True)
+
+    # 列ごとにリスト化して束ねる（混在型の2次元配列を経由しない）
+    marker_data = list(zip(
+        map_df["緯度"].tolist(),
+        map_df["経度"].tolist(),
+        build_popup_html(map_df).tolist(),
+        map_df["店名"].astype(object).fillna("").astype(str).tolist(),
+    ))
+    FastMarkerCluster(data=marker_data, callback=MARKER_CALLBACK).add_to(m)
+
+    return m.get_root().render()
+
+def build_cell_updates(original, edited):
+    """変更のあったセルだけを batch_update 用の範囲リストにする（行・列の位置は original で決まる）"""
+    # ヘッダー行の分だけ +2（1始まり + ヘッダー）
+    row_nums = {idx: pos + 2 for pos, idx in enumerate(original.index)}
+    col_nums = {col: pos + 1 for pos, col in enumerate(original.columns)}
+    original = original.loc[edited.index, edited.columns]
+    changed = (edited.astype(object) != original.astype(object)).stack()
+
+    updates = []
+    for idx, col in changed[changed].index:
+        value = edited.at[idx, col]
+        if hasattr(value, "item"):
+            value = value.item()  # numpy型はJSONにできないのでPythonの型に戻す
+        updates.append({
+            "range": gspread.utils.rowcol_to_a1(row_nums[idx], col_nums[col]),
+            "values": [[value]],
+        })
+    return updates
+
+def sheet_matches_snapshot(sheet, orig_df, key_columns=("店名", "登録日")):
+    """シートが読み込み時から変わっていないか（行数と key_columns の値）を確認"""
+    values = sheet.get_all_values()
+    if not values:
+        return orig_df.empty
+    header, rows = values[0], values[1:]
+    if len(rows) != len(orig_df):
+        return False
+    for col in key_columns:
+        if col not in header:
+            return False
+        pos = header.index(col)
+        current = [row[pos] if pos < len(row) else "" for row in rows]
+        loaded = orig_df[col].astype(object).fillna("").astype(str).tolist()
+        if current != loaded:
+            return False
+    return True
+
+def deleted_row_blocks(row_nums):
+    """削除する行番号を連続したブロック (start, end) にまとめる（下の行から順に）"""
+    blocks = []
+    for row_num in sorted(row_nums, reverse=True):
+        if blocks and blocks[-1][0] == row_num + 1:
+            blocks[-1] = (row_num, blocks[-1][1])
+        else:
+            blocks.append((row_num, row_num))
+    return blocks
+
+@functools.cache
+def get_editor_column_config():
+    """お店リスト編集用の列設定（一度だけ作って使い回す）"""
+    return {
+        "削除": st.column_config.CheckboxColumn(
+            "削除",
+            help="チェックして保存ボタンを押すと削除されます",
+            default=False,
+        ),
+        "店名": st.column_config.TextColumn("店名", required=True),
+        "ジャンル": st.column_config.SelectboxColumn(
+            "ジャンル",
+            options=GENRE_OPTIONS
+        ),
+        "エリア": st.column_config.SelectboxColumn(
+            "エリア",
+            options=AREA_OPTIONS
+        ),
+        "評価": st.column_config.NumberColumn("評価", min_value=1, max_value=5, format="%d"),
+        "登録日": st.column_config.TextColumn("登録日", disabled=True), # 登録日は編集不可にする
+        "緯度": st.column_config.NumberColumn("緯度", format="%.6f"),
+        "経度": st.column_config.NumberColumn("経度", format="%.6f"),
+    }
+
+def has_unsaved_edits():
+    """お店リストに保存していない変更があるか"""
+    state = st.session_state.get(EDITOR_KEY)
+    if not state:
+        return False
+    return any(state.get(k) for k in ("edited_rows", "added_rows", "deleted_rows"))
+
+def on_tab_change():
+    """未保存の変更があるうちは一覧画面から離れない（表示されないウィジェットの状態は消えてしまうため）"""
+    if st.session_state["active_tab"] != "map" and has_unsaved_edits():
+        st.session_state["active_tab"] = "map"
+        st.session_state["tab_switch_blocked"] = True
+
+@st.fragment
+def edit_list_fragment(df, expected_columns):
+    """お店リストの検索・編集・保存（入力中はこの部分だけ再実行する）"""
+    st.divider()
+    st.subheader("お店リスト（編集・削除）")
+    st.caption("表のセルを直接書き換えて修正できます。「削除」にチェックを入れて保存すると削除されます。")
+
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        search_query = st.text_input("キーワード検索", placeholder="店名・ジャンル・住所など")
+    with col2:
+        if st.button("データ再読み込み"):
+            load_sheet_df.clear()
+            st.session_state.pop(EDITOR_KEY, None)  # 編集中の変更も破棄する
+            st.rerun()
+
+    # 編集用のデータフレーム準備（削除用チェックボックス列を先頭に追加）
+    edit_df = df.assign(削除=False)[["削除", *df.columns]]
+    
+    # 検索フィルタリング
+    if search_query:
+        haystack = get_search_haystack(df)
+        # 正規表現は使わず部分一致で検索する（パターンのコンパイルが発生せず、Arrow形式ならそのまま高速に走査できる）
+        mask = haystack.str.contains(search_query, case=False, regex=False, na=False)
+        edit_df = edit_df.loc[mask]
+
+    # 編集用ウィジェットの表示
+    edited_df = st.data_editor(
+        edit_df,
+        use_container_width=True,
+        hide_index=True,
+        num_rows="fixed", # 行の追加は新規登録タブで行う運用にする
+        column_config=get_editor_column_config(),
+        key=EDITOR_KEY,
+    )
+
+    # 保存ボタン
+    if st.button("変更を保存する", type="primary"):
+        try:
+            # 削除チェックがついている行と「削除」列をまとめて除外
+            keep_cols = [c for c in edited_df.columns if c != "削除"]
+            keep_mask = ~edited_df["削除"].to_numpy(dtype=bool)
+            save_df = edited_df.loc[keep_mask, keep_cols]
+            
+            # 検索中の編集かもしれないので、オリジナルのdfに対して更新をかける必要があるが、
+            # 簡易実装として「現在表示されている全データ（検索絞り込み含む）」ではなく
+            # 「検索で見えていないデータ」が消えないように注意が必要。
+            # → Streamlitの仕様上、フィルタ後のedited_dfをそのまま保存するとフィルタ外のデータが消えるリスクがある。
+            
+            # 安全策: 
+            # 1. 検索していない状態（全件表示）の時だけ保存を許可するか、
+            # 2. ID管理をする必要がある。
+            
+            if search_query:
+                st.warning("⚠️ 検索絞り込み中は保存できません。検索ワードを空にして全件表示してから編集・保存してください。")
+            else:
+                with st.spinner("スプレッドシートを更新中..."):
+                    # マスタの列順序に合わせてデータを整理（予期せぬ列順序変更を防ぐ）
+                    # 存在しない列があればNoneで埋めるなどが必要だが、基本はsave_dfを信じる
+                    # ただし save_df の列順序が column_config 等で変わっている可能性も考慮し、
+                    # expected_columns の順序で並べ直すのが安全
+                    
+                    # 足りない列は空文字で作り、NaNはその場で空文字に置換（JSONシリアライズ対策）
+                    final_save_df = save_df.reindex(columns=expected_columns, fill_value="").astype(object)
+                    final_save_df.fillna("", inplace=True)
+
+                    sheet = get_worksheet(SHEET_NAME)
+                    orig_df = st.session_state["orig_df"]
+                    full_rewrite = list(orig_df.columns) != expected_columns
+
+                    # 全データ書き換えは列構成が違うシートが対象なので、行数とシートにある列だけで確認する
+                    if full_rewrite:
+                        key_columns = [c for c in ("店名", "登録日") if c in orig_df.columns]
+                    else:
+                        key_columns = ("店名", "登録日")
+
+                    if not sheet_matches_snapshot(sheet, orig_df, key_columns):
+                        # 読み込み後に追加・削除された行を消したり、別のお店を書き換えたりしないよう中止
+                        st.warning(STALE_SHEET_WARNING)
+                    else:
+                        if full_rewrite:
+                            # シートの列構成がマスタと違う場合は全データ書き換えで揃える
+                            # ヘッダー行 + データ行
+                            update_values = [expected_columns] + final_save_df.to_numpy().tolist()
+                            sheet.clear()
+                            sheet.update(range_name="A1", values=update_values)
+                        else:
+                            # 変更のあったセルだけをまとめて1回で更新
+                            updates = build_cell_updates(orig_df.astype(object).fillna(""), final_save_df)
+                            if updates:
+                                sheet.batch_update(updates)
+
+                            # 削除行は行番号がずれないよう下のブロックから消す
+                            deleted_rows = [orig_df.index.get_loc(idx) + 2 for idx in edited_df.index[~keep_mask]]
+                            for start, end in deleted_row_blocks(deleted_rows):
+                                sheet.delete_rows(start, end)
+
+                        load_sheet_df.clear()
+                        
+                        # 保存済みの変更を新しいデータに再適用しないよう編集状態を消す
+                        st.session_state.pop(EDITOR_KEY, None)
+
+                        st.success("✅ 変更を保存しました！")
+                        time.sleep(1)
+                        st.rerun()
+
+        except Exception as e:
+            st.error(f"保存エラー: {e}")
+
 def main():
     st.set_page_config(page_title="立川グルメ", layout="centered")
 
@@ -78,12 +433,18 @@ def main():
 
     st.title("🍽️ 立川グルメマップ")
 
+    # --- 未送信の新規登録 ---
+    # 新規登録画面から離れたら、溜めておいた登録をまとめて送信してから読み込む
+    if st.session_state.get("active_tab", "map") != "register" and st.session_state.get("pending_inserts"):
+        try:
+            count = flush_pending_inserts()
+            st.toast(f"✅ {count} 件の新規登録を送信しました")
+        except Exception as e:
+            st.error(f"登録エラー: {e}")
+
     # --- データ読み込み ---
     try:
-        client = get_connection()
-        sheet = client.open(SHEET_NAME).sheet1
-        data = sheet.get_all_records()
-        df = pd.DataFrame(data)
+        df = load_sheet_df(SHEET_NAME)
         
         # マスタのカラム順序を定義（スプレッドシートと合わせる）
         expected_columns = ["店名", "ジャンル", "エリア", "評価", "メモ", "住所", "登録日", "緯度", "経度"]
@@ -95,158 +456,107 @@ def main():
             if col not in df.columns:
                 df[col] = None
 
+        # 保存時に差分を取るため、読み込んだ時点のデータを保持
+        st.session_state["orig_df"] = df
+
     except Exception as e:
         st.error(f"データ読み込みエラー: {e}")
         st.stop()
 
     # --- タブ構成 ---
-    tab1, tab2 = st.tabs(["🗺️ マップ・一覧編集", "✏️ 新規登録"])
+    # st.tabs は全タブの中身を毎回実行するため、選択中の画面だけを実行する
+    tab_labels = {"map": "🗺️ マップ・一覧編集", "register": "✏️ 新規登録"}
+    active_tab = st.radio(
+        "画面",
+        list(tab_labels),
+        format_func=tab_labels.get,
+        horizontal=True,
+        label_visibility="collapsed",
+        key="active_tab",
+        on_change=on_tab_change,
+    )
 
     # --- Tab 1: マップ表示 & 編集機能 ---
-    with tab1:
+    if active_tab == "map":
+        if st.session_state.pop("tab_switch_blocked", False):
+            st.warning("⚠️ お店リストに保存していない変更があります。「変更を保存する」で保存するか、「データ再読み込み」で変更を破棄してから画面を切り替えてください。")
+
         st.subheader("お店マップ")
         
-        map_df = df.copy()
-        map_df["緯度"] = pd.to_numeric(map_df["緯度"], errors='coerce')
-        map_df["経度"] = pd.to_numeric(map_df["経度"], errors='coerce')
-        map_df = map_df.dropna(subset=["緯度", "経度"])
+        # 全体をコピーせず、座標のある行だけを取り出す
+        # 緯度・経度は読み込み時に数値化済み
+        map_df = df.loc[df["緯度"].notna() & df["経度"].notna()]
 
         if FOLIUM_AVAILABLE and not map_df.empty:
-            center_lat = map_df["緯度"].mean()
-            center_lon = map_df["経度"].mean()
-            
-            m = folium.Map(location=[center_lat, center_lon], zoom_start=14)
-
-            for _, row in map_df.iterrows():
-                gmap_url = f"https://www.google.com/maps/search/?api=1&query={row['緯度']},{row['経度']}"
-                
-                popup_html = f"""
-                <div style="font-family:sans-serif; min-width:150px;">
-                    <b>{row['店名']}</b><br>
-                    <span style="font-size:0.9em; color:gray;">{row['ジャンル']} / {row['エリア']}</span><br>
-                    <br>
-                    {str(row['メモ'])[:20]}...<br>
-                    <a href="{gmap_url}" target="_blank" style="color:blue; text-decoration:underline;">Googleマップで見る</a>
-                </div>
-                """
-                
-                folium.Marker(
-                    [row["緯度"], row["経度"]],
-                    popup=folium.Popup(popup_html, max_width=200),
-                    tooltip=row["店名"]
-                ).add_to(m)
-
-            st_folium(m, width="100%", height=400)
+            # 地図上の操作をPython側で使わないので、静的なHTMLとして一方向に表示（パン・ズームで再実行しない）
+            components.html(build_map_html(map_df[MAP_COLUMNS]), height=400, scrolling=False)
             
         elif not FOLIUM_AVAILABLE:
-            st.warning("地図機能を使うには 'folium' と 'streamlit-folium' をインストールしてください。")
+            st.warning("地図機能を使うには 'folium' をインストールしてください。")
         else:
             st.info("📍 位置情報付きのデータがまだありません。")
 
-        # --- 編集機能付き一覧リスト ---
-        st.divider()
-        st.subheader("お店リスト（編集・削除）")
-        st.caption("表のセルを直接書き換えて修正できます。「削除」にチェックを入れて保存すると削除されます。")
-
-        col1, col2 = st.columns([3, 1])
-        with col1:
-            search_query = st.text_input("キーワード検索", placeholder="店名・ジャンル・住所など")
-        with col2:
-            if st.button("データ再読み込み"):
-                st.rerun()
-
-        # 編集用のデータフレーム準備
-        edit_df = df.copy()
-        # 削除用チェックボックス列を先頭に追加
-        edit_df.insert(0, "削除", False)
-        
-        # 検索フィルタリング
-        if search_query:
-            mask = edit_df.astype(str).apply(lambda x: x.str.contains(search_query, case=False)).any(axis=1)
-            edit_df = edit_df[mask]
-
-        # 編集用ウィジェットの表示
-        edited_df = st.data_editor(
-            edit_df,
-            use_container_width=True,
-            hide_index=True,
-            num_rows="fixed", # 行の追加は新規登録タブで行う運用にする
-            column_config={
-                "削除": st.column_config.CheckboxColumn(
-                    "削除",
-                    help="チェックして保存ボタンを押すと削除されます",
-                    default=False,
-                ),
-                "店名": st.column_config.TextColumn("店名", required=True),
-                "ジャンル": st.column_config.SelectboxColumn(
-                    "ジャンル",
-                    options=["和食", "洋食", "中華", "イタリアン", "ラーメン", "カフェ", "居酒屋", "その他"]
-                ),
-                "エリア": st.column_config.SelectboxColumn(
-                    "エリア",
-                    options=["北口", "南口", "グリーンスプリングス", "ららぽーと", "駅ナカ", "その他"]
-                ),
-                "評価": st.column_config.NumberColumn("評価", min_value=1, max_value=5, format="%d"),
-                "登録日": st.column_config.TextColumn("登録日", disabled=True), # 登録日は編集不可にする
-                "緯度": st.column_config.NumberColumn("緯度", format="%.6f"),
-                "経度": st.column_config.NumberColumn("経度", format="%.6f"),
-            }
-        )
-
-        # 保存ボタン
-        if st.button("変更を保存する", type="primary"):
-            try:
-                # 削除チェックがついている行を除外
-                save_df = edited_df[~edited_df["削除"]].drop(columns=["削除"])
-                
-                # 検索中の編集かもしれないので、オリジナルのdfに対して更新をかける必要があるが、
-                # 簡易実装として「現在表示されている全データ（検索絞り込み含む）」ではなく
-                # 「検索で見えていないデータ」が消えないように注意が必要。
-                # → Streamlitの仕様上、フィルタ後のedited_dfをそのまま保存するとフィルタ外のデータが消えるリスクがある。
-                
-                # 安全策: 
-                # 1. 検索していない状態（全件表示）の時だけ保存を許可するか、
-                # 2. ID管理をする必要がある。
-                
-                if search_query:
-                    st.warning("⚠️ 検索絞り込み中は保存できません。検索ワードを空にして全件表示してから編集・保存してください。")
-                else:
-                    with st.spinner("スプレッドシートを更新中..."):
-                        # マスタの列順序に合わせてデータを整理（予期せぬ列順序変更を防ぐ）
-                        # 存在しない列があればNoneで埋めるなどが必要だが、基本はsave_dfを信じる
-                        # ただし save_df の列順序が column_config 等で変わっている可能性も考慮し、
-                        # expected_columns の順序で並べ直すのが安全
-                        
-                        final_save_df = save_df.reindex(columns=expected_columns)
-                        
-                        # NaNを空文字に置換（JSONシリアライズ対策）
-                        final_save_df = final_save_df.fillna("")
+        # --- 住所からの一括位置取得 ---
+        has_address = df["住所"].fillna("").astype(str).str.strip() != ""
+        pending = df.index[(df["緯度"].isna() | df["経度"].isna()) & has_address]
 
-                        # スプレッドシート更新（全データ書き換え）
-                        # ヘッダー行 + データ行
-                        update_values = [final_save_df.columns.tolist()] + final_save_df.values.tolist()
-                        
-                        sheet.clear()
-                        sheet.update(range_name="A1", values=update_values)
-                        
-                        st.success("✅ 変更を保存しました！")
-                        time.sleep(1)
-                        st.rerun()
+        if GEOPY_AVAILABLE and len(pending) > 0:
+            st.caption(f"住所はあるが位置情報がないお店が {len(pending)} 件あります。")
+            if st.button("住所から一括取得"):
+                if list(df.columns) != expected_columns:
+                    st.warning("⚠️ シートの列構成がマスタと異なります。一度「変更を保存する」で列を揃えてから実行してください。")
+                else:
+                    found = {}
+                    failed = []
+                    with st.spinner(f"{len(pending)} 件の住所を検索中..."):
+                        for idx in pending:
+                            # 1件失敗しても、それまでに見つかった分は書き込めるよう個別に処理
+                            try:
+                                loc = geocode_addr(compose_geocode_query(str(df.at[idx, "住所"])))
+                            except Exception as geo_err:
+                                failed.append(f"{df.at[idx, '店名']}: {geo_err}")
+                                continue
+                            if loc:
+                                found[idx] = {"緯度": loc[0], "経度": loc[1]}
+
+                    if failed:
+                        st.error("位置検索エラー:\n" + "\n".join(f"- {msg}" for msg in failed))
+
+                    if found:
+                        try:
+                            sheet = get_worksheet(SHEET_NAME)
+                            # 検索中に他の人が行を追加・削除していたら、別のお店に書き込まないよう中止
+                            if not sheet_matches_snapshot(sheet, df):
+                                st.warning(STALE_SHEET_WARNING)
+                            else:
+                                # 見つかった分をまとめて1回で書き込む
+                                found_df = pd.DataFrame.from_dict(found, orient="index")
+                                sheet.batch_update(build_cell_updates(df, found_df))
+                                load_sheet_df.clear()
+                                st.success(f"✅ {len(found)} 件の位置情報を登録しました！")
+                                # エラーがあった場合はメッセージを残すため再読み込みしない
+                                if not failed:
+                                    time.sleep(1)
+                                    st.rerun()
+                        except Exception as e:
+                            st.error(f"位置情報の登録エラー: {e}")
+                    elif not failed:
+                        st.warning("⚠️ 位置情報が見つかりませんでした。")
 
-            except Exception as e:
-                st.error(f"保存エラー: {e}")
+        # --- 編集機能付き一覧リスト ---
+        edit_list_fragment(df, expected_columns)
 
     # --- Tab 2: 新規登録 ---
-    with tab2:
+    elif active_tab == "register":
         st.subheader("新しいお店を登録")
         
         with st.form("register_form", clear_on_submit=True):
             col_a, col_b = st.columns(2)
             with col_a:
                 name = st.text_input("店名", placeholder="例：立川餃子センター")
-                genre = st.selectbox("ジャンル", ["和食", "洋食", "中華", "イタリアン", "ラーメン", "カフェ", "居酒屋", "その他"])
+                genre = st.selectbox("ジャンル", GENRE_OPTIONS)
             with col_b:
-                area = st.selectbox("エリア", ["北口", "南口", "グリーンスプリングス", "ららぽーと", "駅ナカ", "その他"])
+                area = st.selectbox("エリア", AREA_OPTIONS)
                 rating = st.slider("評価", 1, 5, 3)
             
             comment = st.text_area("メモ", placeholder="おすすめメニューなど")
@@ -290,26 +600,11 @@ def main():
                         if GEOPY_AVAILABLE and (not lat_val or not lon_val) and address:
                             with st.spinner(f"「{address}」を検索中..."):
                                 try:
-                                    geolocator = Nominatim(user_agent="tachikawa_app")
-                                    
-                                    # 1回目：そのまま検索
-                                    loc = geolocator.geocode(address)
-                                    
-                                    # 2回目：見つからない場合、「東京都立川市」を付与して再検索
-                                    if not loc:
-                                        search_word = address
-                                        if "立川" not in search_word:
-                                            search_word = "東京都立川市 " + search_word
-                                        elif "東京都" not in search_word:
-                                            search_word = "東京都 " + search_word
-                                            
-                                        if search_word != address:
-                                            loc = geolocator.geocode(search_word)
+                                    loc = geocode_addr(compose_geocode_query(address))
 
                                     if loc:
-                                        lat_val = loc.latitude
-                                        lon_val = loc.longitude
-                                        st.success(f"📍 住所から位置が見つかりました: {loc.address}")
+                                        lat_val, lon_val, found_address = loc
+                                        st.success(f"📍 住所から位置が見つかりました: {found_address}")
                                         time.sleep(1)
                                     else:
                                         st.warning("⚠️ 位置情報が見つかりませんでした。住所のみ登録します。")
@@ -321,12 +616,33 @@ def main():
                             name, genre, area, rating, comment, address, timestamp, lat_val, lon_val
                         ]
                         
-                        sheet.append_row(new_row_ordered)
-                        
-                        st.success(f"「{name}」を登録しました！")
-                        st.balloons()
+                        # 1件ずつ送信せず、溜めてからまとめて送信する
+                        pending = st.session_state.setdefault("pending_inserts", [])
+                        pending.append(new_row_ordered)
+
+                        if len(pending) >= PENDING_INSERT_LIMIT:
+                            count = flush_pending_inserts()
+                            st.success(f"「{name}」を含む {count} 件を登録しました！")
+                            st.balloons()
+                        else:
+                            # まだシートには書き込んでいないので、保存済みのように見せない（注意書きは下の未送信一覧に表示）
+                            st.info(f"「{name}」を登録待ちに追加しました。下の「送信」ボタンで保存してください。")
                     except Exception as e:
                         st.error(f"登録エラー: {e}")
 
+        # 未送信の登録があれば一覧と送信ボタンを表示
+        pending = st.session_state.get("pending_inserts")
+        if pending:
+            st.warning(f"未送信の登録: {len(pending)} 件（{'、'.join(str(row[0]) for row in pending)}）。まだスプレッドシートに保存されていないため、ページを再読み込みすると消えます。")
+            if st.button("送信", type="primary"):
+                try:
+                    count = flush_pending_inserts()
+                    st.success(f"✅ {count} 件を登録しました！")
+                    st.balloons()
+                    time.sleep(1)
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"登録エラー: {e}")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file